@@ -1,15 +1,32 @@
-import requests
-import smtplib
+import asyncio
+import hashlib
+import json
+import logging
 import os
+import queue
+import atexit
+import re
+import socket
+import sqlite3
+import sys
 import time
-import schedule
 from datetime import datetime, timedelta, timezone
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+import aiosmtplib
+import httpx
 import openai
+import orjson
 from dotenv import load_dotenv
-from flask import Flask
+from pybloom_live import ScalableBloomFilter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from threading import Thread
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+try:
+    import uvloop
+except ImportError:  # not available on Windows
+    uvloop = None
 
 # === Load environment variables from .env ===
 load_dotenv()
@@ -24,35 +41,139 @@ EMAIL_TO = os.environ.get("EMAIL_TO")
 TEAMS_CHANNEL_EMAIL = os.environ.get("TEAMS_CHANNEL_EMAIL")
 
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
-PROCESSED_TICKETS_FILE = "processed_tickets.txt"
+PROCESSED_TICKETS_FILE = "processed_tickets.txt"  # legacy, imported into PROCESSED_DB_FILE
+PROCESSED_DB_FILE = "processed.db"
+URGENCY_CACHE_FILE = "urgency_cache.jsonl"
+
+TICKETS_URL = f"https://{FRESHDESK_DOMAIN}/api/v2/tickets"
+TICKET_URL_PREFIX = f"https://{FRESHDESK_DOMAIN}/a/tickets/"
+HTTP_TIMEOUT = httpx.Timeout(10, connect=3)
+HTTP_RETRIES = 3
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+POLL_INTERVAL = 60  # seconds
+
+
+# === HTTP Client ===
+# TCP keepalive lets the pooled connection survive the idle gap between ticks.
+KEEPALIVE_SOCKET_OPTIONS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+if hasattr(socket, "TCP_KEEPIDLE"):
+    KEEPALIVE_SOCKET_OPTIONS += [
+        (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3),
+    ]
+
+HTTP = httpx.AsyncClient(
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=HTTP_RETRIES,  # connection errors only; status retries are in fetch_recent_tickets
+        limits=httpx.Limits(max_keepalive_connections=10),
+        socket_options=KEEPALIVE_SOCKET_OPTIONS,
+    ),
+    timeout=HTTP_TIMEOUT,
+)
 
 # === OpenAI Client ===
-client = openai.OpenAI(api_key=OPENAI_API_KEY)
+# HTTP/2 lets concurrent fallback classifications share one connection.
+client = openai.AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=openai.DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=10, max_keepalive_connections=10, keepalive_expiry=60),
+    ),
+)
+
+# === Health Check Server ===
+HEALTH_RESPONSE = "✅ Ticket monitor is running.".encode()
+
 
-# === Flask Web Server ===
-app = Flask("")
+class HealthHandler(BaseHTTPRequestHandler):
+    """Answers Render's health probe with a fixed body."""
 
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(HEALTH_RESPONSE)))
+        self.end_headers()
 
-@app.route("/")
-def home():
-    return "✅ Ticket monitor is running."
+    def do_GET(self):
+        self.do_HEAD()
+        self.wfile.write(HEALTH_RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
 
 
 # === LOGGING ===
+# Records are handed to a queue and written by a background listener thread,
+# so ticks never block on log I/O.
+def setup_logging():
+    file_handler = RotatingFileHandler("ticket_log.txt", maxBytes=5_000_000, backupCount=3, encoding="utf-8")
+    file_formatter = logging.Formatter("[%(asctime)s] %(message)s", datefmt="%Y-%m-%dT%H:%M:%S+00:00")
+    file_formatter.converter = time.gmtime
+    file_handler.setFormatter(file_formatter)
+    stream_handler = logging.StreamHandler(sys.stdout)  # Also print to Render logs
+    stream_handler.setFormatter(logging.Formatter("%(message)s"))
+
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, file_handler, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger = logging.getLogger("ticket_monitor")
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    return logger
+
+
+logger = setup_logging()
+
+
 def log_event(message):
-    with open("ticket_log.txt", "a") as log_file:
-        log_file.write(f"[{datetime.now(timezone.utc).isoformat()}] {message}\n")
-    print(message, flush=True)  # Also print to Render logs
+    logger.info(message)
 
 
 # === FETCH TICKETS ===
-def fetch_recent_tickets():
-    url = f"https://{FRESHDESK_DOMAIN}/api/v2/tickets?order_type=desc&page=1&per_page=100"
+# Only tickets updated since the previous poll are requested; already-seen ones
+# that show up again in the overlap are dropped by the processed-id check.
+POLL_OVERLAP = timedelta(seconds=30)
+LAST_POLL = datetime.now(timezone.utc) - timedelta(seconds=POLL_INTERVAL)
+
+
+def retry_delay(response, attempt):
+    """Seconds to wait before retrying: Retry-After if sent, else exponential backoff."""
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+    return 0.5 * 2 ** attempt
+
+
+async def fetch_recent_tickets():
+    global LAST_POLL
+    poll_started = datetime.now(timezone.utc)
+    params = {
+        "updated_since": LAST_POLL.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "order_type": "desc",
+        "per_page": 100,
+    }
     try:
-        response = requests.get(url, auth=(API_KEY, "X"))
+        for attempt in range(HTTP_RETRIES + 1):
+            response = await HTTP.get(TICKETS_URL, params=params, auth=(API_KEY, "X"))
+            if response.status_code not in RETRY_STATUSES or attempt == HTTP_RETRIES:
+                break
+            delay = retry_delay(response, attempt)
+            if delay > POLL_INTERVAL:
+                break  # rate limited for longer than a tick; the next tick retries
+            await asyncio.sleep(delay)
         log_event(f"🔍 API Status: {response.status_code}")
         if response.status_code == 200:
-            return response.json()
+            tickets = orjson.loads(response.content)
+            LAST_POLL = poll_started - POLL_OVERLAP
+            return tickets
         else:
             log_event(f"❌ Error fetching tickets: {response.text}")
             return []
@@ -61,30 +182,181 @@ def fetch_recent_tickets():
         return []
 
 
+# === KEYWORD SHORT-CIRCUIT ===
+# Unambiguous vocabulary is decided locally; only ambiguous tickets reach GPT.
+URGENT_RE = re.compile(
+    r"\b(down|outage|p0|critical|broken|cannot\s+(login|access)|not\s+working|production|urgent|asap)\b",
+    re.I,
+)
+BENIGN_RE = re.compile(r"\b(thank(s| you)|fyi|feedback|feature request)\b", re.I)
+
+
+# === URGENCY CACHE ===
+# temperature=0 makes the classification deterministic, so identical ticket
+# text can safely reuse an earlier answer instead of calling the API again.
+def load_urgency_cache():
+    cache = {}
+    if os.path.exists(URGENCY_CACHE_FILE):
+        with open(URGENCY_CACHE_FILE, "r") as f:
+            for line in f:
+                try:
+                    cache.update(json.loads(line))
+                except ValueError:
+                    continue
+    return cache
+
+
+URGENCY_CACHE: dict[str, bool] = load_urgency_cache()
+
+
+def cache_urgency(key, urgent):
+    URGENCY_CACHE[key] = urgent
+    with open(URGENCY_CACHE_FILE, "a") as f:
+        f.write(json.dumps({key: urgent}) + "\n")
+
+
 # === GPT URGENCY DETECTION ===
-def is_urgent(text):
-    prompt = (
-        "You are an assistant that classifies whether a customer support ticket is urgent.\n"
-        "Reply with only `true` if the message is urgent (e.g. broken, down, critical, high priority), "
-        "or `false` otherwise. Understand the tone of the customer to identify whether it is urgent or not.\n\n"
-        f"Ticket message:\n{text}\n\nIs this urgent?")
+# Single-ticket replies are pinned to exactly one "true" or "false" token.
+URGENCY_PROMPT = (
+    "Is this customer support ticket urgent (e.g. broken, down, critical, high priority)? "
+    "Judge the customer's tone. Reply 'true' or 'false'.\n\nTicket: ")
+# o200k_base (gpt-4.1 tokenizer) ids, from tiktoken.get_encoding("o200k_base").encode("true"/"false").
+# Hard-coded so startup doesn't download the BPE file.
+TRUE_TOKEN = 3309
+FALSE_TOKEN = 7556
+URGENCY_LOGIT_BIAS = {TRUE_TOKEN: 100, FALSE_TOKEN: 100}
+
+
+def urgency_key(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def quick_urgency(text):
+    """Resolve urgency without calling GPT; returns None if undecided."""
+    if URGENT_RE.search(text):
+        log_event("⚡ Urgent keyword match")
+        return True
+    if BENIGN_RE.search(text):
+        log_event("⚡ Benign keyword match")
+        return False
+    cached = URGENCY_CACHE.get(urgency_key(text))
+    if cached is not None:
+        log_event("💾 Urgency cache hit")
+    return cached
+
+
+async def is_urgent(text):
+    urgent = quick_urgency(text)
+    if urgent is not None:
+        return urgent
+
     try:
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="gpt-4.1-mini",
-            messages=[{"role": "user", "content": prompt}],
+            messages=[{"role": "user", "content": URGENCY_PROMPT + text}],
             temperature=0,
-            max_tokens=5,
+            max_tokens=1,
+            logit_bias=URGENCY_LOGIT_BIAS,
         )
-        result = response.choices[0].message.content.strip().lower()
+        result = response.choices[0].message.content
         log_event(f"🧠 GPT-4.1 Response: {result}")
-        return "true" in result
+        urgent = result == "true"
+        cache_urgency(urgency_key(text), urgent)
+        return urgent
     except Exception as e:
         log_event(f"❌ GPT API error: {e}")
         return False
 
 
+async def classify_batch(texts):
+    """Classify several tickets with a single GPT request.
+
+    Tickets settled by keywords or the cache never reach the API. Falls back
+    to one is_urgent call per ticket if the batched reply can't be parsed.
+    """
+    results = [quick_urgency(text) for text in texts]
+    pending = [i for i, urgent in enumerate(results) if urgent is None]
+    if not pending:
+        return results
+    if len(pending) == 1:
+        i = pending[0]
+        results[i] = await is_urgent(texts[i])
+        return results
+
+    batch = [texts[i] for i in pending]
+    try:
+        response = await client.chat.completions.create(
+            model="gpt-4.1-mini",
+            messages=[
+                {"role": "system", "content": (
+                    "You classify whether customer support tickets are urgent "
+                    "(e.g. broken, down, critical, high priority), judging the customer's tone. "
+                    "The user sends a JSON array of ticket messages. Reply with ONLY a JSON object "
+                    '{"urgent": [...]} holding one true/false per message, in the same order.')},
+                {"role": "user", "content": json.dumps(batch)},
+            ],
+            response_format={"type": "json_object"},
+            temperature=0,
+            max_tokens=20 + 3 * len(batch),
+        )
+        result = response.choices[0].message.content
+        log_event(f"🧠 GPT-4.1 Batch Response: {result}")
+        labels = json.loads(result)["urgent"]
+        if len(labels) != len(batch) or not all(isinstance(label, bool) for label in labels):
+            raise ValueError(f"expected {len(batch)} booleans")
+    except Exception as e:
+        log_event(f"❌ GPT batch error, classifying individually: {e}")
+        labels = await asyncio.gather(*(is_urgent(text) for text in batch))
+    else:
+        for text, urgent in zip(batch, labels):
+            cache_urgency(urgency_key(text), urgent)
+
+    for i, urgent in zip(pending, labels):
+        results[i] = urgent
+    return results
+
+
 # === SEND EMAIL ALERT ===
-def send_alert_email(subject, body, ticket_url):
+# One logged-in SMTP session is shared by the alerts of a tick and closed when
+# the tick ends, so an idle-timed-out session is never reused. The lock
+# serializes use of it across concurrent sends.
+_SMTP = None
+_SMTP_LOCK = asyncio.Lock()
+
+
+async def _open_smtp():
+    server = aiosmtplib.SMTP(hostname="smtp.office365.com", port=587, start_tls=True, timeout=30)
+    await server.connect()
+    await server.login(EMAIL_FROM, EMAIL_PASS)
+    return server
+
+
+async def _sendmail(recipients, message):
+    global _SMTP
+    async with _SMTP_LOCK:
+        if _SMTP is None:
+            _SMTP = await _open_smtp()
+        try:
+            await _SMTP.sendmail(EMAIL_FROM, recipients, message)
+        except (aiosmtplib.SMTPServerDisconnected, ConnectionError):
+            # The server dropped the session mid-tick; reconnect once.
+            _SMTP = await _open_smtp()
+            await _SMTP.sendmail(EMAIL_FROM, recipients, message)
+
+
+async def close_smtp():
+    global _SMTP
+    async with _SMTP_LOCK:
+        if _SMTP is None:
+            return
+        try:
+            await _SMTP.quit()
+        except Exception:
+            _SMTP.close()
+        _SMTP = None
+
+
+async def send_alert_email(subject, body, ticket_url):
     msg = MIMEMultipart()
     msg["From"] = EMAIL_FROM
     msg["To"] = EMAIL_TO
@@ -102,86 +374,123 @@ def send_alert_email(subject, body, ticket_url):
     msg.attach(MIMEText(html_content, "html"))
 
     try:
-        with smtplib.SMTP("smtp.office365.com", 587) as server:
-            server.starttls()
-            server.login(EMAIL_FROM, EMAIL_PASS)
-            log_event(f"📨 Sending email to: {recipients}")
-            server.sendmail(EMAIL_FROM, recipients, msg.as_string())
-            log_event("✅ Email sent!")
+        log_event(f"📨 Sending email to: {recipients}")
+        await _sendmail(recipients, msg.as_string())
+        log_event("✅ Email sent!")
     except Exception as e:
         log_event(f"❌ Failed to send email: {e}")
 
 
 # === TRACK PROCESSED TICKETS ===
-def read_processed_ids():
+def open_processed_db():
+    conn = sqlite3.connect(PROCESSED_DB_FILE, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS processed(id INTEGER PRIMARY KEY)")
     if os.path.exists(PROCESSED_TICKETS_FILE):
         with open(PROCESSED_TICKETS_FILE, "r") as f:
-            return set(line.strip() for line in f.readlines())
-    return set()
+            ids = [(int(line),) for line in f if line.strip().isdigit()]
+        conn.executemany("INSERT OR IGNORE INTO processed(id) VALUES(?)", ids)
+        os.rename(PROCESSED_TICKETS_FILE, PROCESSED_TICKETS_FILE + ".migrated")
+    return conn
+
+
+PROCESSED_DB = open_processed_db()
+# A bloom filter answers "definitely new" from memory at ~1 byte per id; only
+# possible hits are confirmed against the DB, so dedup stays exact.
+_SEEN = ScalableBloomFilter(initial_capacity=10_000, error_rate=1e-3)
+for (_id,) in PROCESSED_DB.execute("SELECT id FROM processed"):
+    _SEEN.add(_id)
+
+
+def is_processed(ticket_id):
+    if ticket_id not in _SEEN:
+        return False
+    return PROCESSED_DB.execute("SELECT 1 FROM processed WHERE id=?", (ticket_id,)).fetchone() is not None
 
 
 def mark_processed(ticket_id):
-    with open(PROCESSED_TICKETS_FILE, "a") as f:
-        f.write(f"{ticket_id}\n")
+    _SEEN.add(ticket_id)
+    PROCESSED_DB.execute("INSERT OR IGNORE INTO processed(id) VALUES(?)", (ticket_id,))
 
 
 # === MAIN LOGIC ===
-def check_recent_tickets():
+async def handle_ticket(ticket_id, subject, description, ticket_url, urgent):
+    log_event(f"Processed ticket {ticket_id} | urgent={urgent}")
+    if urgent:
+        log_event(f"🚨 Urgent ticket detected: {ticket_id}")
+        await send_alert_email(subject or "No Subject", description or "No Description", ticket_url)
+    else:
+        log_event(f"✅ Ticket {ticket_id} is not urgent.")
+
+
+async def check_recent_tickets():
     log_event("\n🔄 Checking tickets...")
-    tickets = fetch_recent_tickets()
+    # Tickets created anywhere in the polled window count as recent, so a
+    # window left behind by a failed poll is still covered next tick.
+    recent_cutoff = LAST_POLL
+    tickets = await fetch_recent_tickets()
     log_event(f"Found {len(tickets)} tickets from API")
     if not tickets:
         return
 
-    processed_ids = read_processed_ids()
-    recent_cutoff = datetime.now(timezone.utc) - timedelta(minutes=1)
+    batch = []
 
     for ticket in tickets:
-        ticket_id = str(ticket["id"])
-        created_at = datetime.fromisoformat(ticket["created_at"].replace("Z", "+00:00"))
-
-        if ticket_id in processed_ids:
+        # Cheapest checks first; strings are only built for tickets that pass.
+        ticket_id = ticket["id"]
+        if ticket.get("responder_id") is not None or is_processed(ticket_id):
             continue
+        created_at = datetime.fromisoformat(ticket["created_at"].replace("Z", "+00:00"))
         if created_at < recent_cutoff:
             continue
-        if ticket.get("responder_id") is not None:
-            continue
 
         subject = ticket.get("subject", "")
         description = ticket.get("description", "")
         full_text = f"{subject} {description}".strip()
-        ticket_url = f"https://{FRESHDESK_DOMAIN}/a/tickets/{ticket_id}"
+        ticket_url = TICKET_URL_PREFIX + str(ticket_id)
 
         mark_processed(ticket_id)
+        batch.append((ticket_id, subject, description, ticket_url, full_text))
 
-        try:
-            urgent = is_urgent(full_text)
-            log_event(f"Processed ticket {ticket_id} | urgent={urgent}")
-            if urgent:
-                log_event(f"🚨 Urgent ticket detected: {ticket_id}")
-                send_alert_email(subject or "No Subject", description or "No Description", ticket_url)
-            else:
-                log_event(f"✅ Ticket {ticket_id} is not urgent.")
-        except Exception as e:
-            log_event(f"❌ Error processing ticket {ticket_id}: {e}")
+    if not batch:
+        return
+
+    try:
+        labels = await classify_batch([full_text for *_, full_text in batch])
+    except Exception as e:
+        log_event(f"❌ Error classifying tickets: {e}")
+        return
+
+    await asyncio.gather(*(
+        handle_ticket(ticket_id, subject, description, ticket_url, urgent)
+        for (ticket_id, subject, description, ticket_url, _), urgent in zip(batch, labels)
+    ))
+    await close_smtp()
 
 
 # === SCHEDULE JOB ===
-def schedule_job():
-    schedule.every(10).minutes.do(check_recent_tickets)
-    log_event("⏱️ Scheduled to run every 10 minute.")
+async def run_forever():
+    log_event(f"⏱️ Scheduled to run every {POLL_INTERVAL} seconds.")
+    loop = asyncio.get_running_loop()
+    next_fire = loop.time()
     while True:
-        schedule.run_pending()
-        time.sleep(10)
+        try:
+            await check_recent_tickets()
+        except Exception as e:
+            log_event(f"❌ Tick failed: {e}")
+        next_fire += POLL_INTERVAL
+        await asyncio.sleep(max(0, next_fire - loop.time()))
 
 
 # === ENTRY POINT ===
 if __name__ == "__main__":
-    # Run scheduler in background
-    Thread(target=schedule_job).start()
-
-    # Run one immediate check for testing
-    check_recent_tickets()
-
-    # Run Flask in main thread (Render expects this)
-    app.run(host="0.0.0.0", port=8080)
+    # Serve the health check in background (Render expects port 8080)
+    health_server = ThreadingHTTPServer(("0.0.0.0", 8080), HealthHandler)
+    Thread(target=health_server.serve_forever, daemon=True).start()
+
+    # Run the scheduler's event loop in main thread; the first check fires immediately
+    if uvloop is not None:
+        uvloop.run(run_forever())
+    else:
+        asyncio.run(run_forever())